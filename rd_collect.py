@@ -32,51 +32,100 @@
 #
 
 import os
+import csv
 import errno
 import subprocess
 import sys
-import glob
 import re
 import shlex
 import string
+import tempfile
 import json
-from multiprocessing import Pool
-from timeit import Timer
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
+from PIL import Image
 
 # Tests
-vmaf = "vmaf --json --model version=vmaf_v0.6.1 --feature psnr --feature psnr_hvs --feature float_ssim --feature float_ms_ssim --feature ciede"
-
-# Path to tmp dir to be used by the tests
-tmpdir = "/tmp/"
+vmaf = [
+    "vmaf",
+    "--json",
+    "--model",
+    "version=vmaf_v0.6.1",
+    "--feature",
+    "psnr",
+    "--feature",
+    "psnr_hvs",
+    "--feature",
+    "float_ssim",
+    "--feature",
+    "float_ms_ssim",
+    "--feature",
+    "ciede",
+]
+
+# Path to tmp dir to be used by the tests, in memory when /dev/shm is available
+tmpdir = "/dev/shm/" if os.path.ismount("/dev/shm") else tempfile.gettempdir() + "/"
+
+# Number of threads given to each vmaf run, set per worker by init_worker
+vmaf_threads = 1
+
+# Per process prefix of the files in tmpdir, set per worker by init_worker
+tmp_prefix = tmpdir + str(os.getpid()) + "-"
+
+# Number of decoded images converted to Y4M by a single ffmpeg run
+ffmpeg_batch = 4
+
+# Columns of the results files
+lossless_columns = [
+    "file_name",
+    "orig_file_size",
+    "compressed_file_size",
+    "pixels",
+    "bpp",
+    "compression_ratio",
+    "encode_time",
+    "decode_time",
+]
+lossy_columns = [
+    "file_name",
+    "quality",
+    "orig_file_size",
+    "compressed_file_size",
+    "pixels",
+    "bpp",
+    "compression_ratio",
+    "encode_time",
+    "decode_time",
+    "ssim_score",
+    "msssim_score",
+    "ciede2000_score",
+    "psnrhvs_score",
+    "vmaf_score",
+    "butteraugli_score",
+    "dssim_score",
+    "ssimulacra_score",
+]
 
 #############################################################################
 
 
-def split(cmd):
-    lex = shlex.shlex(cmd)
-    lex.quotes = '"'
-    lex.whitespace_split = True
-    lex.commenters = ""
-    return list(lex)
-
+def compile_recipe(cmd):
+    # Tokenize once, each argument is then substituted on its own so paths are
+    # never re-tokenized
+    return [string.Template(arg) for arg in shlex.split(cmd)]
 
-def run_silent(cmd):
-    FNULL = open(os.devnull, "w")
-    rv = subprocess.call(split(cmd), stdout=FNULL, stderr=FNULL)
-    if rv != 0:
-        sys.stderr.write("Failure from subprocess:\n")
-        sys.stderr.write("\t" + cmd + "\n")
-        sys.stderr.write("Aborting!\n")
-        sys.exit(rv)
-    return rv
 
+def recipe_argv(templates, **values):
+    return [template.substitute(values) for template in templates]
 
-def wrapper(func, *args, **kwargs):
-    def wrapped():
-        return func(*args, **kwargs)
 
-    return wrapped
+def run_timed(argv):
+    start = time.perf_counter()
+    subprocess.run(
+        argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+    )
+    return time.perf_counter() - start
 
 
 def create_dir(path):
@@ -89,163 +138,128 @@ def create_dir(path):
 
 
 def path_for_file_in_tmp(path):
-    return tmpdir + str(os.getpid()) + os.path.basename(path)
+    return tmp_prefix + os.path.basename(path)
 
 
-def get_img_width(path):
-    cmd = "identify -format %%w %s" % (path)
-    proc = subprocess.Popen(
-        split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8"
-    )
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        sys.stderr.write("Failed process: identify\n")
-        sys.exit(proc.returncode)
-    lines = out.split(os.linesep)
-    return int(lines[0].strip())
-
-
-def get_img_height(path):
-    cmd = "identify -format %%h %s" % (path)
-    proc = subprocess.Popen(
-        split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8"
-    )
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        sys.stderr.write("Failed process: identify\n")
-        sys.exit(proc.returncode)
-    lines = out.split(os.linesep)
-    return int(lines[0].strip())
+def get_img_info(path):
+    # Only the PNG header is parsed, the pixels are not decoded
+    with Image.open(path) as img:
+        # Same as identify reporting "srgba": grayscale + alpha is not included
+        has_alpha = img.mode == "RGBA" or (
+            img.mode in ("RGB", "P") and "transparency" in img.info
+        )
+        return img.width, img.height, has_alpha
 
 
 def convert_img(inn, out):
     # PNG24: needed otherwise grayscale image lose their sRGB colorspace
-    cmd = "convert %s PNG24:%s" % (inn, out)
-    run_silent(cmd)
+    argv = ["convert", inn, "PNG24:" + out]
+    subprocess.run(
+        argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+    )
 
 
-def detect_alpha(img):
-    cmd = "identify -format '%%[channels]' %s" % (img)
-    proc = subprocess.Popen(
-        split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8"
+def convert_ppm(inn, out):
+    argv = ["convert", inn, "PPM:" + out]
+    subprocess.run(
+        argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
     )
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        sys.stderr.write("Failed process: %s\n" % (cmd))
-        sys.exit(proc.returncode)
-
-    channels = out.split(os.linesep)[0]
-    if channels == "srgba":
-        return True;
-    return False
 
 
 def remove_alpha(inn, out):
     # PNG24: needed otherwise grayscale image lose their sRGB colorspace
-    cmd = "convert %s -alpha off PNG24:%s" % (inn, out)
-    run_silent(cmd)
+    argv = ["convert", inn, "-alpha", "off", "PNG24:" + out]
+    subprocess.run(
+        argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+    )
 
 
-def convertff_img(inn, out):
-    # 10le -strict -1
-    cmd = (
-        "ffmpeg -y -i %s -pix_fmt yuv444p -vf scale=in_range=full:out_range=full %s"
-        % (inn, out)
+def convertff_imgs(pairs):
+    # A single ffmpeg process converts every (inn, out) pair
+    argv = ["ffmpeg", "-y"]
+    for inn, out in pairs:
+        argv += ["-i", inn]
+    for i, (inn, out) in enumerate(pairs):
+        # 10le -strict -1
+        argv += [
+            "-map",
+            str(i),
+            "-pix_fmt",
+            "yuv444p",
+            "-vf",
+            "scale=in_range=full:out_range=full",
+            out,
+        ]
+    subprocess.run(
+        argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
     )
-    run_silent(cmd)
 
 
 def get_score(y4m1, y4m2, target_json):
-    cmd = "%s -r %s -d %s -o %s" % (vmaf, y4m1, y4m2, target_json)
-    proc = subprocess.Popen(
-        split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8"
-    )
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        sys.stderr.write("Failed process: %s\n" % (cmd))
-        sys.exit(proc.returncode)
-
-    with open(target_json) as f:
-        data = f.read()
-        scores = json.loads(data)
-        psnrhvs_score = scores["pooled_metrics"]["psnr_hvs"]["mean"]
-        ssim_score = scores["pooled_metrics"]["float_ssim"]["mean"]
-        msssim_score = scores["pooled_metrics"]["float_ms_ssim"]["mean"]
-        ciede2000_score = scores["pooled_metrics"]["ciede2000"]["mean"]
-        vmaf_score = scores["pooled_metrics"]["vmaf"]["mean"]
+    argv = vmaf + [
+        "--threads",
+        str(vmaf_threads),
+        "-r",
+        y4m1,
+        "-d",
+        y4m2,
+        "-o",
+        target_json,
+    ]
+    subprocess.run(argv, capture_output=True, text=True, check=True)
+
+    with open(target_json, "rb") as f:
+        pooled = json.load(f)["pooled_metrics"]
+
+    psnrhvs_score = pooled["psnr_hvs"]["mean"]
+    ssim_score = pooled["float_ssim"]["mean"]
+    msssim_score = pooled["float_ms_ssim"]["mean"]
+    ciede2000_score = pooled["ciede2000"]["mean"]
+    vmaf_score = pooled["vmaf"]["mean"]
 
     return ssim_score, msssim_score, ciede2000_score, psnrhvs_score, vmaf_score
 
 
 def get_butteraugli(png1, png2):
-    cmd = "butteraugli_main %s %s" % (png1, png2)
-    proc = subprocess.Popen(
-        split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8"
-    )
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        sys.stderr.write("Failed process: %s\n" % (cmd))
-        sys.exit(proc.returncode)
+    argv = ["butteraugli_main", png1, png2]
+    out = subprocess.run(argv, capture_output=True, text=True, check=True).stdout
 
     butteraugli_score = float(out.split(os.linesep)[0])
     return butteraugli_score
 
 
 def get_dssim(png1, png2):
-    cmd = "dssim %s %s" % (png1, png2)
-    proc = subprocess.Popen(
-        split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8"
-    )
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        sys.stderr.write("Failed process: %s\n" % (cmd))
-        sys.exit(proc.returncode)
+    argv = ["dssim", png1, png2]
+    out = subprocess.run(argv, capture_output=True, text=True, check=True).stdout
     line = out.split(os.linesep)[0]
     dssim_score = float(re.search("^\d+\.?\d*", line).group(0))
     return dssim_score
 
 
-def get_ssimulacra(png1, png2):
-    cmd = "ssimulacra_main %s %s" % (png1, png2)
-    proc = subprocess.Popen(
-        split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8"
-    )
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        sys.stderr.write("Failed process: %s\n" % (cmd))
-        sys.exit(proc.returncode)
+def get_ssimulacra(ref, png2):
+    # ssimulacra_main reads images through OpenCV, the reference can be a PPM
+    argv = ["ssimulacra_main", ref, png2]
+    out = subprocess.run(argv, capture_output=True, text=True, check=True).stdout
     ssimulacra_score = float(out.split(os.linesep)[0])
     return ssimulacra_score
 
 
 # Returns tuple containing:
 #   (target_file_size, encode_time, decode_time)
-def get_lossless_results(subset_name, origpng, format, format_recipe):
-
-    origppm = os.path.splitext(origpng)[0] + ".ppm";
+def get_lossless_results(
+    origpng, origppm, base_out, format_recipe, lossless_tpl, decode_tpl
+):
 
-    target = (
-        format.upper()
-        + "_out/"
-        + subset_name
-        + "/"
-        + os.path.splitext(os.path.basename(origpng))[0]
-        + "/"
-        + os.path.splitext(os.path.basename(origpng))[0]
-        + "-lossless"
-    )
-    create_dir(target)
+    target = base_out + "-lossless"
     target_dec = path_for_file_in_tmp(target)
 
     target += "." + format_recipe["encode_extension"]
-    cmd = string.Template(format_recipe["lossless_cmd"]).substitute(locals())
-    wrapped = wrapper(run_silent, cmd)
-    encode_time = Timer(wrapped).timeit(5) / 5
+    argv = recipe_argv(lossless_tpl, origpng=origpng, origppm=origppm, target=target)
+    encode_time = run_timed(argv)
 
     target_dec += "." + format_recipe["decode_extension"]
-    cmd = string.Template(format_recipe["decode_cmd"]).substitute(locals())
-    wrapped = wrapper(run_silent, cmd)
-    decode_time = Timer(wrapped).timeit(5) / 5
+    argv = recipe_argv(decode_tpl, target=target, target_dec=target_dec)
+    decode_time = run_timed(argv)
 
     target_file_size = os.path.getsize(target)
 
@@ -258,40 +272,36 @@ def get_lossless_results(subset_name, origpng, format, format_recipe):
 
 
 # Returns tuple containing:
-#   (target_file_size, encode_time, decode_time, yssim_score, rgbssim_score,
-#   psnrhvsm_score, msssim_score)
-def get_lossy_results(
-    subset_name, origpng, width, height, format, format_recipe, quality
+#   (target, target_dec, target_png, target_y4m, encode_time, decode_time)
+def encode_lossy(
+    origpng,
+    base_out,
+    width,
+    height,
+    has_alpha,
+    format_recipe,
+    encode_tpl,
+    decode_tpl,
+    quality,
 ):
 
-    origy4m = path_for_file_in_tmp(origpng) + ".y4m"
-    convertff_img(origpng, origy4m)
-
-    target = (
-        format.upper()
-        + "_out/"
-        + subset_name
-        + "/"
-        + os.path.splitext(os.path.basename(origpng))[0]
-        + "/"
-        + os.path.splitext(os.path.basename(origpng))[0]
-        + "-q"
-        + str(quality)
-    )
-    create_dir(target)
+    target = base_out + "-q" + str(quality)
     target_dec = path_for_file_in_tmp(target)
 
     target += "." + format_recipe["encode_extension"]
-    cmd = string.Template(format_recipe["encode_cmd"]).substitute(locals())
-    wrapped = wrapper(run_silent, cmd)
-    encode_time = Timer(wrapped).timeit(1)
-
-    target_json = target_dec + ".json"
+    argv = recipe_argv(
+        encode_tpl,
+        origpng=origpng,
+        target=target,
+        quality=quality,
+        width=width,
+        height=height,
+    )
+    encode_time = run_timed(argv)
 
     target_dec += "." + format_recipe["decode_extension"]
-    cmd = string.Template(format_recipe["decode_cmd"]).substitute(locals())
-    wrapped = wrapper(run_silent, cmd)
-    decode_time = Timer(wrapped).timeit(1)
+    argv = recipe_argv(decode_tpl, target=target, target_dec=target_dec)
+    decode_time = run_timed(argv)
 
     if format_recipe["decode_extension"] != "png":
         target_png = path_for_file_in_tmp(target_dec) + ".png"
@@ -300,29 +310,44 @@ def get_lossy_results(
         target_png = target_dec
 
     # libavif bug?
-    if not detect_alpha(origpng):
+    if not has_alpha:
         remove_alpha(target_png, target_png)
 
+    # Not created yet, process_image converts target_dec to it in a batch
     target_y4m = path_for_file_in_tmp(target_dec) + ".y4m"
-    convertff_img(target_dec, target_y4m)
+
+    return (target, target_dec, target_png, target_y4m, encode_time, decode_time)
+
+
+# Returns tuple containing:
+#   (target_file_size, encode_time, decode_time, ssim_score, msssim_score,
+#   ciede2000_score, psnrhvs_score, vmaf_score, butteraugli_score,
+#   dssim_score, ssimulacra_score)
+def get_lossy_results(origpng, ssimulacra_ref, origy4m, encoded):
+    target, target_dec, target_png, target_y4m, encode_time, decode_time = encoded
+
+    target_json = path_for_file_in_tmp(target_dec) + ".json"
 
     ssim_score, msssim_score, ciede2000_score, psnrhvs_score, vmaf_score = get_score(
         origy4m, target_y4m, target_json
     )
 
-    butteraugli_score = get_butteraugli(origpng, target_png)
-    dssim_score = get_dssim(origpng, target_png)
-    ssimulacra_score = get_ssimulacra(origpng, target_png)
+    # The metric tools are separate processes, threads are enough to overlap them
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        butteraugli = executor.submit(get_butteraugli, origpng, target_png)
+        dssim = executor.submit(get_dssim, origpng, target_png)
+        ssimulacra = executor.submit(get_ssimulacra, ssimulacra_ref, target_png)
+        butteraugli_score = butteraugli.result()
+        dssim_score = dssim.result()
+        ssimulacra_score = ssimulacra.result()
 
     target_file_size = os.path.getsize(target)
 
-    try:
-        os.remove(origy4m)
-        os.remove(target_dec)
-        os.remove(target_json)
-        os.remove(target_y4m)
-    except FileNotFoundError:
-        pass
+    for f in (target_dec, target_png, target_json, target_y4m):
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
 
     return (
         target_file_size,
@@ -339,167 +364,241 @@ def get_lossy_results(
     )
 
 
-def process_image(args):
-    [format, format_recipe, subset_name, origpng] = args
+def iter_pngs(path):
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # Hidden files are skipped like glob("*.png") did, e.g. "._foo.png"
+            if (
+                entry.name.endswith(".png")
+                and not entry.name.startswith(".")
+                and entry.is_file()
+            ):
+                yield entry.path
+
+
+def init_worker(threads):
+    global vmaf_threads, tmp_prefix
+    vmaf_threads = threads
+    tmp_prefix = tmpdir + str(os.getpid()) + "-"
 
-    result_file = (
+
+def get_result_file(subset_name, format, kind, stem):
+    return (
         "results/"
         + subset_name
         + "/"
         + format
-        + "/lossy/"
-        + os.path.splitext(os.path.basename(origpng))[0]
+        + "/"
+        + kind
+        + "/"
+        + stem
         + "."
         + format
         + ".out"
     )
-    if os.path.isfile(result_file) and not os.stat(result_file).st_size == 0:
-        return
 
-    try:
-        isfloat = (
-            isinstance(format_recipe["quality_start"], float)
-            or isinstance(format_recipe["quality_end"], float)
-            or isinstance(format_recipe["quality_step"], float)
-        )
 
-        if isfloat:
-            start = float(format_recipe["quality_start"])
-            end = float(format_recipe["quality_end"])
-            step = float(format_recipe["quality_step"])
-        else:
-            start = int(format_recipe["quality_start"])
-            end = int(format_recipe["quality_end"])
-            step = int(format_recipe["quality_step"])
-    except ValueError:
-        print("There was an error parsing the format recipe.")
-        return
+# Returns tuple containing:
+#   (complete rows of a lossy results file, whether it holds anything else)
+def read_lossy_rows(result_file):
+    if not os.path.isfile(result_file):
+        return [], False
+
+    with open(result_file, newline="") as file:
+        data = file.read()
+
+    # A last line without newline was cut short by an interrupted run
+    lines = data.splitlines()
+    malformed = bool(data) and not data.endswith("\n")
+    if malformed:
+        lines = lines[:-1]
+
+    reader = csv.reader(lines, delimiter=":")
+    if next(reader, lossy_columns) != lossy_columns:
+        return [], True
+
+    rows = []
+    for row in reader:
+        try:
+            if len(row) != len(lossy_columns) or not row[0]:
+                raise ValueError
+            for value in row[1:]:
+                float(value)
+        except ValueError:
+            malformed = True
+            continue
+        rows.append(row)
 
-    if (
-        not "encode_extension" in format_recipe
-        or not "decode_extension" in format_recipe
-        or not "encode_cmd" in format_recipe
-        or not "lossless_cmd" in format_recipe
-        or not "decode_cmd" in format_recipe
+    return rows, malformed
+
+
+# Returns tuple containing:
+#   (rows to keep, qualities still to compute)
+def get_pending_qualities(quality_list, rows):
+    # rd_average.py merges the results files by row position, so rows written
+    # by a previous run are only reused while they follow quality_list in order
+    done = 0
+    while (
+        done < len(rows)
+        and done < len(quality_list)
+        and round(float(rows[done][1]), 6) == round(float(quality_list[done]), 6)
     ):
-        print("There was an error parsing the format recipe.")
-        return
+        done += 1
+
+    return rows[:done], quality_list[done:]
+
+
+def process_image(args):
+    [format, format_recipe, subset_name, quality_list, origpng] = args
+
+    stem = os.path.splitext(os.path.basename(origpng))[0]
+    base_out = format.upper() + "_out/" + subset_name + "/" + stem + "/" + stem
+    result_file = get_result_file(subset_name, format, "lossy", stem)
+
+    read_rows, malformed = read_lossy_rows(result_file)
+    rows, quality_list = get_pending_qualities(quality_list, read_rows)
+
+    # Drop the truncated, invalid or out of order rows and recompute from the
+    # first missing quality
+    if malformed or len(rows) != len(read_rows):
+        with open(result_file, "w", newline="") as file:
+            writer = csv.writer(file, delimiter=":", lineterminator="\n")
+            writer.writerow(lossy_columns)
+            writer.writerows(rows)
+        if not quality_list:
+            return
+
+    encode_tpl = compile_recipe(format_recipe["encode_cmd"])
+    decode_tpl = compile_recipe(format_recipe["decode_cmd"])
+    lossless_tpl = compile_recipe(format_recipe["lossless_cmd"])
 
     orig_file_size = os.path.getsize(origpng)
-    width = get_img_width(origpng)
-    height = get_img_height(origpng)
+    width, height, has_alpha = get_img_info(origpng)
     pixels = width * height
 
+    create_dir(base_out)
+
     # Lossless
     print("Processing image {}, quality lossless".format(os.path.basename(origpng)))
 
     origppm = os.path.splitext(origpng)[0] + ".ppm";
     ppm_file_size = os.path.getsize(origppm)
 
-    path = (
-        "results/"
-        + subset_name
-        + "/"
-        + format
-        + "/lossless/"
-        + os.path.splitext(os.path.basename(origpng))[0]
-        + "."
-        + format
-        + ".out"
-    )
+    path = get_result_file(subset_name, format, "lossless", stem)
     create_dir(path)
-    file = open(path, "w")
+    with open(path, "w", newline="", buffering=1 << 20) as file:
+        writer = csv.writer(file, delimiter=":", lineterminator="\n")
+        writer.writerow(lossless_columns)
 
-    file.write(
-        "file_name:orig_file_size:compressed_file_size:pixels:bpp:compression_ratio:encode_time:decode_time\n"
-    )
-
-    results = get_lossless_results(subset_name, origpng, format, format_recipe)
-    bpp = results[0] * 8 / pixels
-    compression_ratio = ppm_file_size / results[0]
-    file.write(
-        "%s:%d:%d:%d:%f:%f:%f:%f\n"
-        % (
-            os.path.splitext(os.path.basename(origpng))[0],
-            ppm_file_size,
-            results[0],
-            pixels,
-            bpp,
-            compression_ratio,
-            results[1],
-            results[2],
-        )
-    )
-
-    file.close()
-
-    if "png" in format:
-        return
-
-    # Lossy
-    path = (
-        "results/"
-        + subset_name
-        + "/"
-        + format
-        + "/lossy/"
-        + os.path.splitext(os.path.basename(origpng))[0]
-        + "."
-        + format
-        + ".out"
-    )
-    create_dir(path)
-    file = open(path, "w")
-
-    file.write(
-        "file_name:quality:orig_file_size:compressed_file_size:pixels:bpp:compression_ratio:encode_time:decode_time:ssim_score:msssim_score:ciede2000_score:psnrhvs_score:vmaf_score:butteraugli_score:dssim_score:ssimulacra_score\n"
-    )
-    if isfloat:
-        quality_list = list(np.arange(start, end, step))
-    else:
-        quality_list = list(range(start, end, step))
-
-    i = 0
-    while i < len(quality_list):
-        quality = quality_list[i]
-        print(
-            "Processing image {}, quality {}".format(os.path.basename(origpng), quality)
-        )
-        results = get_lossy_results(
-            subset_name, origpng, width, height, format, format_recipe, quality
+        results = get_lossless_results(
+            origpng, origppm, base_out, format_recipe, lossless_tpl, decode_tpl
         )
         bpp = results[0] * 8 / pixels
-        compression_ratio = orig_file_size / results[0]
-        file.write(
-            "%s:%f:%d:%d:%d:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f:%f\n"
-            % (
-                os.path.splitext(os.path.basename(origpng))[0],
-                quality,
-                orig_file_size,
+        compression_ratio = ppm_file_size / results[0]
+        writer.writerow(
+            [
+                stem,
+                ppm_file_size,
                 results[0],
                 pixels,
                 bpp,
                 compression_ratio,
                 results[1],
                 results[2],
-                results[3],
-                results[4],
-                results[5],
-                results[6],
-                results[7],
-                results[8],
-                results[9],
-                results[10],
-            )
+            ]
         )
-        i += 1
 
-    file.close()
+    if "png" in format or not quality_list:
+        return
+
+    # Lossy
+    create_dir(result_file)
+    new_file = not os.path.isfile(result_file) or os.stat(result_file).st_size == 0
+    origy4m = path_for_file_in_tmp(origpng) + ".y4m"
+    refppm = path_for_file_in_tmp(origpng) + ".ppm"
+
+    with open(result_file, "a", newline="") as file:
+        writer = csv.writer(file, delimiter=":", lineterminator="\n")
+        if new_file:
+            writer.writerow(lossy_columns)
+
+        try:
+            convertff_imgs([(origpng, origy4m)])
+
+            # Decode the reference once for ssimulacra instead of once per
+            # quality. PPM has no alpha channel, so those images keep the PNG
+            if has_alpha:
+                ssimulacra_ref = origpng
+            else:
+                convert_ppm(origpng, refppm)
+                ssimulacra_ref = refppm
+
+            # Qualities are handled in small groups so only a few decoded images
+            # are kept in tmpdir at once, and each group is flushed before the
+            # next one so an interrupted run can resume
+            for i in range(0, len(quality_list), ffmpeg_batch):
+                encoded = []
+                for quality in quality_list[i : i + ffmpeg_batch]:
+                    print(
+                        "Processing image {}, quality {}".format(
+                            os.path.basename(origpng), quality
+                        )
+                    )
+                    encoded.append(
+                        (
+                            quality,
+                            encode_lossy(
+                                origpng,
+                                base_out,
+                                width,
+                                height,
+                                has_alpha,
+                                format_recipe,
+                                encode_tpl,
+                                decode_tpl,
+                                quality,
+                            ),
+                        )
+                    )
+
+                # Convert the decoded images of the group with one ffmpeg
+                # process, this has to happen before get_lossy_results reads
+                # each target_y4m
+                pairs = []
+                for quality, (_, target_dec, _, target_y4m, _, _) in encoded:
+                    pairs.append((target_dec, target_y4m))
+                convertff_imgs(pairs)
+
+                for quality, encoded_quality in encoded:
+                    results = get_lossy_results(
+                        origpng, ssimulacra_ref, origy4m, encoded_quality
+                    )
+                    bpp = results[0] * 8 / pixels
+                    compression_ratio = orig_file_size / results[0]
+                    writer.writerow(
+                        [
+                            stem,
+                            float(quality),
+                            orig_file_size,
+                            results[0],
+                            pixels,
+                            bpp,
+                            compression_ratio,
+                        ]
+                        + list(results[1:])
+                    )
+                file.flush()
+        finally:
+            for f in (origy4m, refppm):
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
 
 
 def main(argv):
-    if sys.version_info[0] < 3 and sys.version_info[1] < 5:
-        raise Exception("Python 3.5 or a more recent version is required.")
+    if sys.version_info < (3, 7):
+        raise Exception("Python 3.7 or a more recent version is required.")
 
     data = {}
     try:
@@ -510,13 +609,14 @@ def main(argv):
 
     supported_formats = list(data["recipes"].keys())
 
-    if len(argv) != 4:
+    if len(argv) < 4 or len(argv) > 5:
         print(
             "rd_collect.py: Generate compressed images from Y4Ms and calculate quality and speed metrics for a given format"
         )
         print("Arg 1: format to test {}".format(supported_formats))
         print("Arg 2: name of the subset to test (e.g. 'subset1')")
         print("Arg 3: path to the subset to test (e.g. 'subset1/')")
+        print("Arg 4: number of worker processes (default to the number of CPUs)")
         return
 
     format = argv[1]
@@ -529,15 +629,77 @@ def main(argv):
         )
         return
 
-    pool = Pool(processes=16)
-    pool.map(
-        process_image,
-        [
-            (format, data["recipes"][format], subset_name, origpng)
-            for origpng in glob.glob(argv[3] + "/*.png")
-        ],
+    format_recipe = data["recipes"][format]
+    try:
+        isfloat = (
+            isinstance(format_recipe["quality_start"], float)
+            or isinstance(format_recipe["quality_end"], float)
+            or isinstance(format_recipe["quality_step"], float)
+        )
+
+        if isfloat:
+            start = float(format_recipe["quality_start"])
+            end = float(format_recipe["quality_end"])
+            step = float(format_recipe["quality_step"])
+        else:
+            start = int(format_recipe["quality_start"])
+            end = int(format_recipe["quality_end"])
+            step = int(format_recipe["quality_step"])
+    except ValueError:
+        print("There was an error parsing the format recipe.")
+        return
+
+    if (
+        not "encode_extension" in format_recipe
+        or not "decode_extension" in format_recipe
+        or not "encode_cmd" in format_recipe
+        or not "lossless_cmd" in format_recipe
+        or not "decode_cmd" in format_recipe
+    ):
+        print("There was an error parsing the format recipe.")
+        return
+
+    if isfloat:
+        quality_list = list(np.arange(start, end, step))
+    else:
+        quality_list = list(range(start, end, step))
+
+    try:
+        nproc = int(argv[4])
+    except IndexError:
+        nproc = os.cpu_count() or 1
+    except ValueError:
+        print("The number of worker processes must be an integer.")
+        return
+    if nproc < 1:
+        print("The number of worker processes must be at least 1.")
+        return
+
+    # Images whose lossy results are complete never reach the pool
+    origpngs = []
+    for origpng in iter_pngs(argv[3]):
+        stem = os.path.splitext(os.path.basename(origpng))[0]
+        read_rows, malformed = read_lossy_rows(
+            get_result_file(subset_name, format, "lossy", stem)
+        )
+        rows, pending = get_pending_qualities(quality_list, read_rows)
+        if malformed or len(rows) != len(read_rows) or pending:
+            origpngs.append(origpng)
+    chunksize = max(1, len(origpngs) // (nproc * 4))
+    args = (
+        (format, format_recipe, subset_name, quality_list, origpng)
+        for origpng in origpngs
     )
 
+    # Share the CPUs left over by the pool between the vmaf runs
+    threads = max(1, (os.cpu_count() or 1) // nproc)
+
+    with ProcessPoolExecutor(
+        max_workers=nproc, initializer=init_worker, initargs=(threads,)
+    ) as executor:
+        for _ in executor.map(process_image, args, chunksize=chunksize):
+            pass
+
 
 if __name__ == "__main__":
     main(sys.argv)
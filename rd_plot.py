@@ -31,6 +31,7 @@
 import os
 import sys
 import glob
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import matplotlib
@@ -39,232 +40,182 @@ matplotlib.use("Cairo")
 import matplotlib.pyplot as plt
 
 
-def generate_plots(path, requested_formats):
-    data = {}
-    subset_name = os.path.basename(path)
+# Columns of the rd_average.py lossy results actually used for plotting
+columns = [
+    "avg_bpp",
+    "wavg_ssim_score",
+    "wavg_msssim_score",
+    "wavg_ciede2000_score",
+    "wavg_psnrhvs_score",
+    "wavg_vmaf_score",
+    "wavg_butteraugli_score",
+    "wavg_dssim_score",
+    "wavg_ssimulacra_score",
+    "wavg_encode_time",
+]
 
-    for format in requested_formats:
-        file = path + "/" + subset_name + "." + format + ".lossy.out"
-        data[format] = pd.read_csv(file, sep=":")
 
-    # SSIM
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title("Quality according to SSIM in function of number of bits per pixel")
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("Float SSIM")
-    plt.xscale("log")
-    plt.xlim([0.1, 5])
-    plt.ylim([0.96, 1])
-    plt.minorticks_on()
-    plt.grid(b=True, which="both", color="0.65", linestyle="--")
-    for format in data:
-        plt.plot(data[format]["avg_bpp"], data[format]["wavg_ssim_score"], label=format)
-    plt.legend()
-    plt.savefig(
-        path + "/" + subset_name + ".ssim.(" + ",".join(requested_formats) + ").svg"
-    )
-    plt.close(fig)
+# Range of bits per pixel shown on every plot
+xlim = [0.1, 5]
 
-    # CIEDE2000
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title("Quality according to CIEDE2000 in function of number of bits per pixel")
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("dB (CIEDE2000)")
-    plt.xscale("log")
-    plt.xlim([0.1, 5])
-    plt.ylim([30, 50])
-    plt.minorticks_on()
-    plt.grid(b=True, which="both", color="0.65", linestyle="--")
-    for format in data:
-        plt.plot(
-            data[format]["avg_bpp"], data[format]["wavg_ciede2000_score"], label=format
-        )
-    plt.legend()
-    plt.savefig(
-        path
-        + "/"
-        + subset_name
-        + ".ciede2000.("
-        + ",".join(requested_formats)
-        + ").svg"
-    )
-    plt.close(fig)
+# Curves with more points than this are downsampled before being drawn
+max_points = 200
 
-    # MS-SSIM
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title("Quality according to MS-SSIM in function of number of bits per pixel")
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("Float MS-SSIM")
-    plt.xscale("log")
-    plt.xlim([0.1, 5])
-    plt.ylim([0.85, 1.01])
-    plt.minorticks_on()
-    plt.grid(b=True, which="both", color="0.65", linestyle="--")
-    for format in data:
-        plt.plot(
-            data[format]["avg_bpp"], data[format]["wavg_msssim_score"], label=format
-        )
-    plt.legend()
-    plt.savefig(
-        path + "/" + subset_name + ".ms-ssim.(" + ",".join(requested_formats) + ").svg"
-    )
-    plt.close(fig)
+# (name, title, xlabel, ylabel, column, ylim, yscale) of each generated plot
+plots = [
+    (
+        "ssim",
+        "Quality according to SSIM in function of number of bits per pixel",
+        "Bits per pixels",
+        "Float SSIM",
+        "wavg_ssim_score",
+        [0.96, 1],
+        "linear",
+    ),
+    (
+        "ciede2000",
+        "Quality according to CIEDE2000 in function of number of bits per pixel",
+        "Bits per pixels",
+        "dB (CIEDE2000)",
+        "wavg_ciede2000_score",
+        [30, 50],
+        "linear",
+    ),
+    (
+        "ms-ssim",
+        "Quality according to MS-SSIM in function of number of bits per pixel",
+        "Bits per pixels",
+        "Float MS-SSIM",
+        "wavg_msssim_score",
+        [0.85, 1.01],
+        "linear",
+    ),
+    (
+        "psnr-hvs",
+        "Quality according to PSNR-HVS in function of number of bits per pixel",
+        "Bits per pixels",
+        "dB (PSNR-HVS)",
+        "wavg_psnrhvs_score",
+        [25, 50],
+        "linear",
+    ),
+    (
+        "vmaf",
+        "Quality according to VMAF in function of number of bits per pixel",
+        "Bits per pixels",
+        "Score (VMAF)",
+        "wavg_vmaf_score",
+        [75, 100],
+        "linear",
+    ),
+    (
+        "butteraugli",
+        "Quality according to Butteraugli in function of number of bits per pixel",
+        "Bits per pixels",
+        "Error (Butteraugli)",
+        "wavg_butteraugli_score",
+        [2, 25],
+        "log",
+    ),
+    (
+        "dssim",
+        "Quality according to DSSIM in function of number of bits per pixel",
+        "Bits per pixels",
+        "Error (DSSIM)",
+        "wavg_dssim_score",
+        [0.0001, 0.1],
+        "log",
+    ),
+    (
+        "ssimulacra",
+        "Quality according to SSimulacra in function of number of bits per pixel",
+        "Bits per pixels",
+        "Error (SSimulacra)",
+        "wavg_ssimulacra_score",
+        [0.02, 0.25],
+        "log",
+    ),
+    (
+        "encoding_time",
+        "Encoding time in function of average bpp",
+        "Bits per pixel",
+        "Time (s)",
+        "wavg_encode_time",
+        [0.01, 200],
+        "log",
+    ),
+]
 
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title("Quality according to PSNR-HVS in function of number of bits per pixel")
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("dB (PSNR-HVS)")
-    plt.xscale("log")
-    plt.xlim([0.1, 5])
-    plt.ylim([25, 50])
-    plt.minorticks_on()
-    plt.grid(b=True, which="both", color="0.65", linestyle="--")
-    for format in data:
-        plt.plot(
-            data[format]["avg_bpp"], data[format]["wavg_psnrhvs_score"], label=format
-        )
-    plt.legend()
-    plt.savefig(
-        path + "/" + subset_name + ".psnr-hvs.(" + ",".join(requested_formats) + ").svg"
-    )
-    plt.close(fig)
 
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title("Quality according to VMAF in function of number of bits per pixel")
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("Score (VMAF)")
-    plt.xscale("log")
-    plt.xlim([0.1, 5])
-    plt.ylim([75, 100])
-    plt.minorticks_on()
-    plt.grid(b=True, which="both", color="0.65", linestyle="--")
-    for format in data:
-        plt.plot(data[format]["avg_bpp"], data[format]["wavg_vmaf_score"], label=format)
-    plt.legend()
-    plt.savefig(
-        path + "/" + subset_name + ".vmaf.(" + ",".join(requested_formats) + ").svg"
-    )
-    plt.close(fig)
-    plt.close(fig)
+def clip_curve(x, y):
+    inside = np.flatnonzero((x >= xlim[0]) & (x <= xlim[1]))
+    if len(inside):
+        # Keep one point on each side so the curve still reaches the plot edges
+        start = max(inside[0] - 1, 0)
+        end = min(inside[-1] + 2, len(x))
+        x = x[start:end]
+        y = y[start:end]
 
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title(
-        "Quality according to Butteraugli in function of number of bits per pixel"
-    )
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("Error (Butteraugli)")
-    plt.xscale("log")
-    plt.yscale("log")
-    plt.xlim([0.1, 5])
-    plt.ylim([2, 25])
-    plt.minorticks_on()
-    plt.grid(b=True, which="both", color="0.65", linestyle="--")
-    for format in data:
-        plt.plot(
-            data[format]["avg_bpp"],
-            data[format]["wavg_butteraugli_score"],
-            label=format,
-        )
-    plt.legend()
-    plt.savefig(
-        path
-        + "/"
-        + subset_name
-        + ".butteraugli.("
-        + ",".join(requested_formats)
-        + ").svg"
-    )
-    plt.close(fig)
+    if len(x) > max_points:
+        # Stride over all but the last point, which is always kept
+        step = -(-(len(x) - 1) // (max_points - 1))
+        x = np.append(x[:-1:step], x[-1])
+        y = np.append(y[:-1:step], y[-1])
 
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title("Quality according to DSSIM in function of number of bits per pixel")
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("Error (DSSIM)")
-    plt.xscale("log")
-    plt.yscale("log")
-    plt.xlim([0.1, 5])
-    plt.ylim([0.0001, 0.1])
-    plt.minorticks_on()
-    plt.grid(b=True, which="both", color="0.65", linestyle="--")
-    for format in data:
-        plt.plot(
-            data[format]["avg_bpp"], data[format]["wavg_dssim_score"], label=format
-        )
-    plt.legend()
-    plt.savefig(
-        path + "/" + subset_name + ".dssim.(" + ",".join(requested_formats) + ").svg"
-    )
-    plt.close(fig)
+    return x, y
 
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title("Quality according to SSimulacra in function of number of bits per pixel")
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixels")
-    plt.ylabel("Error (SSimulacra)")
-    plt.xscale("log")
-    plt.yscale("log")
-    plt.xlim([0.1, 5])
-    plt.ylim([0.02, 0.25])
-    plt.minorticks_on()
-    plt.grid(b=True, which="both", color="0.65", linestyle="--")
+
+def render_plot(args):
+    [plot, data, path, subset_name, requested_formats] = args
+    name, title, xlabel, ylabel, column, ylim, yscale = plot
+
+    fig, ax = plt.subplots(figsize=(25, 15))
+    fig.suptitle(subset_name)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_xscale("log")
+    ax.set_yscale(yscale)
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    ax.minorticks_on()
+    ax.grid(True, which="both", color="0.65", linestyle="--")
     for format in data:
-        plt.plot(
-            data[format]["avg_bpp"], data[format]["wavg_ssimulacra_score"], label=format
-        )
-    plt.legend()
-    plt.savefig(
+        x, y = clip_curve(data[format]["avg_bpp"].values, data[format][column].values)
+        ax.plot(x, y, label=format)
+    ax.legend()
+    fig.savefig(
         path
         + "/"
         + subset_name
-        + ".ssimulacra.("
+        + "."
+        + name
+        + ".("
         + ",".join(requested_formats)
         + ").svg"
     )
     plt.close(fig)
 
-    fig = plt.figure()
-    plt.figure(figsize=(25, 15))
-    plt.title("Encoding time in function of average bpp")
-    plt.suptitle(subset_name)
-    plt.xlabel("Bits per pixel")
-    plt.ylabel("Time (s)")
-    plt.xscale("log")
-    plt.yscale("log")
-    plt.xlim([0.1, 5])
-    plt.ylim([0.01, 200])
-    plt.minorticks_on()
-    plt.grid(b=True, which="both", color="0.65", linestyle="--")
-    for format in data:
-        plt.plot(
-            data[format]["avg_bpp"], data[format]["wavg_encode_time"], label=format
+
+def generate_plots(path, requested_formats):
+    data = {}
+    subset_name = os.path.basename(path)
+
+    for format in requested_formats:
+        file = path + "/" + subset_name + "." + format + ".lossy.out"
+        data[format] = pd.read_csv(
+            file, sep=":", usecols=columns, dtype=np.float32, engine="c"
         )
-    plt.legend()
-    plt.savefig(
-        path
-        + "/"
-        + subset_name
-        + ".encoding_time.("
-        + ",".join(requested_formats)
-        + ").svg"
-    )
-    plt.close(fig)
 
-    plt.close("all")
+    # The Cairo backend is not thread-safe, render each plot in its own process
+    with ProcessPoolExecutor(
+        max_workers=min(len(plots), os.cpu_count() or 1)
+    ) as executor:
+        for _ in executor.map(
+            render_plot,
+            [(plot, data, path, subset_name, requested_formats) for plot in plots],
+        ):
+            pass
 
 
 def main(argv):